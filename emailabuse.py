@@ -24,11 +24,14 @@ import os
 import tempfile
 import logging
 from module import Payload, ExamineHeaders, ExtractURL, Tokenizer, ArchiveZip, \
-    Archive7z, ArchiveRAR
+    Archive7z, ArchiveRAR, ArchiveTriage, HeaderTriage, Scheduler, Module, analyzer_versions
 import StringIO
 from io import BytesIO
 import re
 import json
+import hashlib
+from journal import Journal, RecordingCache
+from results import MessageResult, PayloadResult, text, write_ndjson, write_msgpack
 
 storepath = 'store'
 
@@ -37,6 +40,7 @@ def create_unique_file():
     if not os.path.exists(storepath):
         os.makedirs(storepath)
     fd, fn = tempfile.mkstemp(dir=storepath)
+    os.close(fd)
     return fn
 
 
@@ -57,7 +61,7 @@ def logging_init(msg_file):
     fh.setFormatter(fh_formatter)
     fh.setLevel(logging.DEBUG)
     logger.addHandler(fh)
-    return logger
+    return logger, fh
 
 
 def store_msg(content, filename):
@@ -72,10 +76,10 @@ def store_msg(content, filename):
 
 def init(msg):
     msg_file = get_filename(create_unique_file())
-    logger = logging_init(msg_file)
+    logger, fh = logging_init(msg_file)
     logger.info('Email abuse - inspecting new mail: %s' % msg_file)
     store_msg(msg, msg_file)
-    return msg_file
+    return msg_file, fh
 
 
 archive_list = [ArchiveZip, Archive7z, ArchiveRAR]
@@ -89,134 +93,416 @@ def get_strings(payload):
     return pattern.findall(payload)
 
 
-def process_payload(filename, body, content_type, origin_domain, passwordlist):
-    is_archive = False
-    unpacked_files = {}
-    results = {}
-    indicators = 0
+def to_filehandle(body):
+    try:
+        return BytesIO(body)
+    except:
+        # broken document...
+        return BytesIO(body.encode('utf-16'))
+
+
+def open_archive(body, content_type, passwordlist):
+    """
+        Returns the archive module and its listing, or None, None if it is not an archive
+    """
     if (content_type is not None
             and "Microsoft Word 2007+" not in content_type
             and "Microsoft Excel 2007+" not in content_type):
         # Maybe an archive
         for a in archive_list:
-            try:
-                filehandle = BytesIO(body)
-            except:
-                # broken document...
-                filehandle = BytesIO(body.encode('utf-16'))
-            archive = a(filehandle, passwordlist)
-            unpacked_files = archive.processing()
-            if unpacked_files is not None and len(unpacked_files) > 0:
-                is_archive = True
-                break
-    if not is_archive:
-        # Assume it is not an archive
-        unpacked_files = {}
-        try:
-            unpacked_files[filename] = BytesIO(body)
-        except:
-            # broken document...
-            unpacked_files[filename] = BytesIO(body.encode('utf-16'))
-
-    for fn, filehandle in unpacked_files.iteritems():
-        if filehandle is None:
-            continue
-        payload = Payload(fn, filehandle, origin_domain)
-        results[fn] = list(payload.processing())
-        indicators += payload.indicators
-    return results, indicators
+            archive = a(to_filehandle(body), passwordlist)
+            members = archive.processing()
+            if members is not None and len(members) > 0:
+                return archive, members
+    return None, None
 
 
-if __name__ == '__main__':
-    argParser = argparse.ArgumentParser(description='email_abuse parser')
-    argParser.add_argument('-r', default='-', help='Filename of the raw email to read (default: stdin)')
-    argParser.add_argument('-o', default='ascii', help='Output format: ascii or json (default: ascii)')
-    args = argParser.parse_args()
-    if args.r == '-':
-        msg = mime.from_string(sys.stdin.read())
+def triage_attachment(filename, body, content_type, origin_domain, passwordlist):
+    """
+        Cheap part of the analysis of an attachment: archive listing and file names,
+        nothing is decompressed.
+        Returns the archive (or None), the Payload modules and the indicators.
+    """
+    archive, members = open_archive(body, content_type, passwordlist)
+    payloads = []
+    indicators = 0
+    if archive is None:
+        # Assume it is not an archive
+        payloads.append(Payload(filename, to_filehandle(body), origin_domain))
     else:
-        fp = open(args.r, 'rb')
-        msg = mime.from_string(fp.read())
+        triage = ArchiveTriage(members)
+        verdicts = triage.processing() or {}
+        indicators += triage.indicators
+        for member in members:
+            fn = member['name']
+            if fn not in verdicts:
+                continue
+            is_suspicious, reason, needs_content = verdicts[fn]
+            # The content is extracted on demand (see analyse_payloads)
+            payload = Payload(fn, None, origin_domain, parse=needs_content)
+            if is_suspicious:
+                payload.flag(reason)
+            payloads.append(payload)
+    for payload in payloads:
+        payload.test_suspicious_extension()
+        indicators += payload.indicators
+    return archive, payloads, indicators
 
-    msg_file = init(msg)
 
-    subject = msg.subject
-    passwordlist = ["password", "passw0rd", "infected", "qwerty", "malicious",
-                    "archive", "zip"]
+def analyse_payloads(archive, payloads, threshold=None, lookup_members=False):
+    """
+        Expensive part of the analysis of an attachment: decompression, hashing,
+        lookups and parsers. Returns the indicators and if the analysis is partial.
+        Archive members scored by name (executables, scripts...) are only decompressed,
+        to be hashed and looked up, if lookup_members is True.
+    """
     indicators = 0
+    for i, payload in enumerate(payloads):
+        if threshold is not None and indicators >= threshold:
+            for skipped in payloads[i:]:
+                skipped.partial = True
+            return indicators, True
+        if payload.payload is None:
+            if not payload.parse and not lookup_members:
+                continue
+            payload.payload = archive.extract(payload.filename)
+            if payload.payload is None:
+                continue
+        # The payload scheduler compares its own indicators, including the file name score
+        # already counted by the triage
+        before = payload.indicators
+        payload.threshold = None if threshold is None else threshold - indicators + before
+        payload.processing()
+        indicators += payload.indicators - before
+    return indicators, any(payload.partial for payload in payloads)
+
+
+default_passwordlist = ["password", "passw0rd", "infected", "qwerty", "malicious",
+                        "archive", "zip"]
+
 
-    examine_headers = ExamineHeaders(msg)
-    origin_ip, rbl_listed, rbl_comment, mailfrom, mailto, origin_domain = examine_headers.processing()
-    indicators += examine_headers.indicators
+def analyse(msg, stop_at=None, header_triage=None, lookup_members=False):
+    """
+        Run the analyzers on a parsed message, cheapest first.
+        If stop_at is set, the analysis stops as soon as the indicators reach it,
+        and the result is flagged as partial.
+        header_triage is the HeaderTriage module already run on the message, if any:
+        its outcome is reused instead of examining the headers again.
+        lookup_members is passed to analyse_payloads().
+    """
+    msg_file, fh = init(msg)
+    try:
+        return _analyse(msg, msg_file, stop_at, header_triage, lookup_members)
+    finally:
+        logging.getLogger().removeHandler(fh)
+        fh.close()
 
-    attachements = []
-    payload_results = []
+
+def _analyse(msg, msg_file, stop_at, header_triage, lookup_members):
+    passwordlist = list(default_passwordlist)
     suspicious_urls = set()
+    result = MessageResult(msg_file=msg_file, subject=msg.subject, indicators=0, partial=False,
+                           triage=False, attachments=[], payloads=[])
+
+    if header_triage is not None:
+        # Headers and RBL status already known
+        examine_headers = header_triage
+    else:
+        # The RBL lookup is remote, it is scheduled with the other expensive tasks
+        examine_headers = ExamineHeaders(msg, rbl=False)
+        examine_headers.processing()
+    origin_ip = examine_headers.origin_ip
+    rbl_comment = examine_headers.rbl_comment
+    mailfrom = examine_headers.mailfrom
+    mailto = examine_headers.mailto
+    origin_domain = examine_headers.origin_domain
+    result.origin_ip = origin_ip
+    result.rbl_comment = rbl_comment
+    result.mailfrom = mailfrom
+    result.mailto = mailto
+    result.indicators += examine_headers.indicators
+
+    def rbl_lookup():
+        indicators = examine_headers.indicators
+        try:
+            examine_headers.rbl_lookup()
+        except Exception as e:
+            logging.exception(e)
+        result.rbl_comment = examine_headers.rbl_comment
+        result.indicators += examine_headers.indicators - indicators
+
+    def extract_urls(content):
+        extractor = ExtractURL(content, origin_domain)
+        suspicious_urls.update(extractor.processing() or [])
+        result.indicators += extractor.indicators
+
+    def tokenize(content):
+        tok = Tokenizer(content)
+        passwordlist.extend(tok.processing() or [])
+        # TODO process that string
+
+    # attachment index: (filename, archive, Payload modules), filled by the triage
+    triaged = {}
+    analysed = set()
+
+    def triage(index, filename, body, content_type):
+        archive, payloads, indicators = triage_attachment(filename, body, content_type,
+                                                          origin_domain, passwordlist)
+        triaged[index] = (filename, archive, payloads)
+        result.indicators += indicators
+
+    def payload(index):
+        analysed.add(index)
+        filename, archive, payloads = triaged[index]
+        threshold = None if stop_at is None else stop_at - result.indicators
+        indicators, partial = analyse_payloads(archive, payloads, threshold, lookup_members)
+        result.indicators += indicators
+        result.partial = result.partial or partial
 
+    scheduler = Scheduler(stop_at)
+    if origin_ip is not None and header_triage is None:
+        scheduler.add(ExamineHeaders.cost, rbl_lookup)
     if msg.content_type.is_multipart():
         for p in msg.walk():
-            extract_urls = ExtractURL(p.body, origin_domain)
-            suspicious_urls |= set(extract_urls.processing())
-            indicators += extract_urls.indicators
+            scheduler.add(ExtractURL.cost, extract_urls, p.body)
             if p.is_body():
-                content = p.body
-                tok = Tokenizer(content)
-                passwordlist += tok.processing()
-                # TODO process that string
+                scheduler.add(Tokenizer.cost, tokenize, p.body)
             elif p.is_attachment() or p.is_inline():
                 content_type = p.detected_content_type
                 filename = p.detected_file_name
-                attachements.append((filename, content_type))
                 if filename is not None and len(filename) > 0:
                     passwordlist.append(filename)
                     prefix, suffix = os.path.splitext(filename)
                     passwordlist.append(prefix)
-                r, r_indicators = process_payload(filename, p.body, content_type, origin_domain, passwordlist)
-                indicators += r_indicators
-                payload_results.append(r)
+                # Scheduled after the tokenizers: they feed the password list
+                index = len(result.attachments)
+                result.attachments.append(text([filename, str(content_type)]))
+                scheduler.add(ArchiveTriage.cost, triage, index, filename, p.body, content_type)
+                scheduler.add(Payload.cost, payload, index)
             else:
                 # What do we do there? Is it possible?
                 pass
     else:  # singlepart
-        extract_urls = ExtractURL(msg.body, origin_domain)
-        suspicious_urls |= set(extract_urls.processing())
-        indicators += extract_urls.indicators
+        scheduler.add(ExtractURL.cost, extract_urls, msg.body)
 
-    if args.o == 'json':
-        print (json.dumps((payload_results, suspicious_urls, indicators), indent=4))
-        sys.exit()
+    if scheduler.run(lambda: result.indicators):
+        result.partial = True
+    for index in sorted(triaged):
+        filename, archive, payloads = triaged[index]
+        for p in payloads:
+            if index not in analysed:
+                p.partial = True
+            result.payloads.append(PayloadResult.from_result(p.filename, filename, p.result()))
+        if archive is not None:
+            archive.close()
+    result.suspicious_urls = sorted(suspicious_urls)
+    return result
+
+
+def analyse_raw(raw, stop_at=None, triage=None, lookup_members=False):
+    """
+        Analyse a raw email. If triage is set, its headers are examined first and
+        only the ones scoring at least triage are fully analysed.
+    """
+    header_triage = None
+    if triage is not None:
+        header_triage = HeaderTriage(raw, triage)
+        if header_triage.processing() is None:
+            # Failed, fallback to the full analysis
+            header_triage = None
+        elif not header_triage.needs_analysis:
+            return MessageResult.from_triage(header_triage)
+    return analyse(mime.from_string(raw), stop_at, header_triage, lookup_members)
+
+
+def list_messages(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for fn in sorted(files):
+                    yield os.path.join(root, fn)
+        else:
+            yield path
+
+
+def run_batch(paths, journal_path, incremental=False, stop_at=None, output='ascii', triage=None,
+              lookup_members=False):
+    """
+        Analyse all the messages in paths, skipping the ones already in the journal
+        (unless they were only cleared by the header triage and this run has none).
+        Messages which cannot be read or analysed are journaled as failed and retried by the next run.
+        In incremental mode, messages analysed with older analyzers are processed again,
+        reusing the journaled outputs of the analyzers whose version did not change.
+    """
+    versions = analyzer_versions()
+    journal = Journal(journal_path)
+    shared_cache = Module.cache
+    try:
+        for path in list_messages(paths):
+            sha1 = None
+            try:
+                with open(path, 'rb') as fp:
+                    raw = fp.read()
+                sha1 = hashlib.sha1(raw).hexdigest()
+                entry = journal.get(sha1)
+                outputs = None
+                if entry is not None and not (entry['triage'] and triage is None):
+                    if not incremental or entry['versions'] == versions:
+                        logging.info("Batch: %s already processed, skipping" % path)
+                        continue
+                    logging.info("Batch: %s processed with other analyzer versions, rescanning" % path)
+                    outputs = journal.outputs(sha1)
+                # Outputs are only kept for this message, the shared cache is bounded
+                cache = RecordingCache(shared_cache, outputs)
+                Module.cache = cache
+                try:
+                    result = analyse_raw(raw, stop_at, triage, lookup_members)
+                finally:
+                    Module.cache = shared_cache
+                result.path = path
+                journal.record(sha1, versions, result.to_dict(), cache.used)
+                output_result(result, output)
+            except Exception as e:
+                # One broken message (unreadable, analysis or report failing) does not stop the batch
+                logging.exception(e)
+                logging.info("Batch: failed to analyse %s: %s" % (path, e))
+                journal.record(sha1, versions, {'path': path}, {}, error=str(e))
+    finally:
+        journal.close()
 
-    print("Email abuse - inspecting email object: %s\n" % msg_file)
+
+def print_report(result):
+    if result.triage:
+        print("Email abuse - header triage: cleared\n")
+    else:
+        print("Email abuse - inspecting email object: %s\n" % result.msg_file)
     print "\tContent type:\tEmail info"
-    print "\tIP Address:\t%s" % origin_ip
-    print "\tSubject:\t%s" % subject
-    print "\tFrom:\t\t%s" % mailfrom
-    print "\tTo:\t\t%s" % mailto
-    if rbl_comment is not None:
-        print "\tSuspicious:\t%s" % rbl_comment
-    if len(attachements) > 0:
+    print "\tIP Address:\t%s" % result.origin_ip
+    print "\tSubject:\t%s" % result.subject
+    print "\tFrom:\t\t%s" % result.mailfrom
+    print "\tTo:\t\t%s" % result.mailto
+    if result.rbl_comment is not None:
+        print "\tSuspicious:\t%s" % result.rbl_comment
+    if len(result.attachments) > 0:
         print "\tAttachements:"
-        for fn, content_type in attachements:
-            print "\t\t%s:\t%s" % (fn, str(content_type))
+        for fn, content_type in result.attachments:
+            print "\t\t%s:\t%s" % (fn, content_type)
     print "\n"
     i = 0
-    for results in payload_results:
-        for filename, infos in results.iteritems():
-            i += 1
-            print "Inspected component #%i:" % i
-            print "\tMime-type:\t%s" % infos[2]
-            print "\tFile name:\t%s - %s" % (filename, infos[1])
-            print "\tSHA1 hash:\t%s" % infos[3]
-            for parser, values in infos[5].iteritems():
-                if values[0] and values[2]:
-                    # one of the parser worked, and the content is suspicious
-                    print "\tSuspicious:\t%s" % values[3]
-            if infos[6][0]:
-                print "\tVirus Total:\t%i positive detections (total scans: %i)" % (int(infos[6][1]), int(infos[6][2]))
-                print "\tVT Report\t%s" % str(infos[6][3].strip())
-            print "\n"
-    if len(suspicious_urls) > 0:
+    for payload in result.payloads:
+        i += 1
+        print "Inspected component #%i:" % i
+        print "\tMime-type:\t%s" % payload.mimetype
+        print "\tFile name:\t%s - %s" % (payload.filename, payload.reason)
+        print "\tSHA1 hash:\t%s" % payload.sha1
+        for verdict in payload.parsers:
+            if verdict.matched and verdict.suspicious:
+                # one of the parser worked, and the content is suspicious
+                print "\tSuspicious:\t%s" % verdict.reason
+        if payload.vt_known:
+            print "\tVirus Total:\t%i positive detections (total scans: %i)" % (int(payload.vt_positives), int(payload.vt_total))
+            print "\tVT Report\t%s" % str(payload.vt_link.strip())
+        print "\n"
+    if len(result.suspicious_urls) > 0:
         print "List of extracted suspicious URLs:"
-        for url in suspicious_urls:
+        for url in result.suspicious_urls:
             print "\t%s" % url
-    print "\nLevel of suspiciousness:\t%i" % indicators
+    if result.partial:
+        print "\nPartial result:\t\tverdict threshold reached, remaining analyzers skipped"
+    print "\nLevel of suspiciousness:\t%i" % result.indicators
+
+
+def output_result(result, output):
+    if output == 'json':
+        print (json.dumps(result.to_dict(), indent=4))
+    elif output == 'ndjson':
+        write_ndjson(result, sys.stdout)
+    elif output == 'msgpack':
+        write_msgpack(result, sys.stdout)
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='email_abuse parser')
+    argParser.add_argument('-r', default='-', help='Filename of the raw email to read (default: stdin)')
+    argParser.add_argument('-o', default='ascii', choices=['ascii', 'json', 'ndjson', 'msgpack'],
+                           help='Output format: ascii, json, ndjson (one line per email) or msgpack (default: ascii)')
+    argParser.add_argument('-t', '--triage', type=int, default=None, metavar='SCORE',
+                           help='Only parse the headers first, run the full analysis if their score reaches SCORE')
+    argParser.add_argument('-b', '--batch', nargs='+', metavar='PATH',
+                           help='Analyse all the raw emails in PATH (files or directories), resuming from the journal')
+    argParser.add_argument('-j', '--journal', default=os.path.join(storepath, 'journal.ndjson'),
+                           help='Journal of the batch runs (default: %(default)s)')
+    argParser.add_argument('-i', '--incremental', action='store_true',
+                           help='In batch mode, rescan the messages processed with older analyzers')
+    argParser.add_argument('-w', '--watch', metavar='DIR',
+                           help='Watch a spool directory (or the new/ directory of a Maildir) and analyse incoming emails')
+    argParser.add_argument('--done', metavar='DIR',
+                           help='In watch mode, where processed emails go '
+                           '(default: cur/ for a Maildir, DIR/done otherwise)')
+    argParser.add_argument('--results', metavar='DIR',
+                           help='In watch mode, where the results go '
+                           '(default: MAILDIR.results next to a Maildir, the --done directory otherwise)')
+    argParser.add_argument('--workers', type=int, default=4, help='In watch mode, number of workers (default: 4)')
+    argParser.add_argument('-q', '--queue', metavar='DB',
+                           help='Distributed mode: SQLite queue shared by the coordinator and the workers')
+    argParser.add_argument('--enqueue', nargs='+', metavar='PATH',
+                           help='Distributed mode: enqueue the raw emails in PATH (files or directories)')
+    argParser.add_argument('--shards', type=int, default=16,
+                           help='Distributed mode: number of shards the emails are spread on (default: 16)')
+    argParser.add_argument('--work', action='store_true', help='Distributed mode: run a worker')
+    argParser.add_argument('--worker-shards', metavar='LIST',
+                           help='Distributed mode: comma separated list of the shards the worker prefers (default: all)')
+    argParser.add_argument('--drain', action='store_true', help='Distributed mode: stop the worker once the queue is empty')
+    argParser.add_argument('--collect', action='store_true', help='Distributed mode: print the results of the completed jobs')
+    argParser.add_argument('-s', '--stop-at', type=int, default=None, metavar='SCORE',
+                           help='Stop the analysis as soon as the level of suspiciousness reaches SCORE')
+    argParser.add_argument('--lookup-members', action='store_true',
+                           help='Decompress the archive members scored by their name (executables, scripts...) '
+                           'to look up their hash on VirusTotal')
+    args = argParser.parse_args()
+    if args.batch:
+        if not os.path.exists(storepath):
+            os.makedirs(storepath)
+        run_batch(args.batch, args.journal, args.incremental, args.stop_at, args.o, args.triage,
+                  args.lookup_members)
+        sys.exit()
+
+    if args.queue:
+        from workqueue import SQLiteBroker, enqueue_messages, run_worker
+        broker = SQLiteBroker(args.queue)
+        if args.enqueue:
+            enqueue_messages(broker, args.enqueue, args.shards)
+        if args.work:
+            shards = None
+            if args.worker_shards:
+                shards = [int(shard) for shard in args.worker_shards.split(',')]
+            run_worker(broker, shards, stop_at=args.stop_at, drain=args.drain, triage=args.triage,
+                       lookup_members=args.lookup_members)
+        if args.collect:
+            for ref, report in broker.results():
+                result = MessageResult.from_dict(report)
+                result.path = ref
+                output_result(result, args.o)
+        sys.exit()
+
+    if args.watch:
+        from watcher import SpoolWatcher, logger as watcher_logger
+        watcher_logger.addHandler(logging.StreamHandler())
+        watcher_logger.setLevel(logging.INFO)
+        SpoolWatcher(args.watch, args.done, args.workers, stop_at=args.stop_at, triage=args.triage,
+                     results=args.results, lookup_members=args.lookup_members).run()
+        sys.exit()
+
+    if args.r == '-':
+        raw = sys.stdin.read()
+    else:
+        fp = open(args.r, 'rb')
+        raw = fp.read()
+        fp.close()
+
+    result = analyse_raw(raw, args.stop_at, args.triage, args.lookup_members)
+    result.path = None if args.r == '-' else args.r
+    output_result(result, args.o)
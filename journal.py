@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+from results import text
+
+
+class RecordingCache(object):
+    """
+        Module cache used while analysing one message of a batch: the outputs journaled
+        for this message are served first, and the outputs used are kept, to be journaled.
+    """
+
+    def __init__(self, cache, outputs=None):
+        self.cache = cache
+        self.outputs = outputs or {}
+        self.used = {}
+
+    def get(self, key):
+        value = self.outputs.get(key)
+        if value is None:
+            value = self.cache.get(key)
+        if value is not None:
+            self.used[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+        self.used[key] = value
+
+
+class Journal(object):
+
+    def __init__(self, path):
+        """
+            Append-only journal of a batch run, one JSON line per analysed message:
+            its hash, the versions of the analyzers, the report and the cached module outputs.
+            Only the hashes, versions and line offsets are kept in memory.
+        """
+        self.path = path
+        self.index = {}
+        self.versions = {}
+        if os.path.exists(path):
+            self.load()
+        self.fd = open(path, 'a')
+        self.fd.seek(0, os.SEEK_END)
+        if self.fd.tell() > 0 and not self.ends_with_newline():
+            # Do not append to the truncated entry
+            self.fd.write('\n')
+        self.reader = open(path, 'r')
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as fd:
+            fd.seek(-1, os.SEEK_END)
+            return fd.read(1) == b'\n'
+
+    def load(self):
+        with open(self.path, 'r') as fd:
+            while True:
+                offset = fd.tell()
+                line = fd.readline()
+                if not line:
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line of an interrupted run
+                    logging.info("Journal: ignoring truncated entry in %s" % self.path)
+                    continue
+                if entry.get('error') is None:
+                    # The last entry of a message wins, failed ones are retried
+                    self.add(entry, offset)
+        logging.info("Journal: %i messages already processed" % len(self.index))
+
+    def add(self, entry, offset):
+        versions = tuple(sorted(entry['versions'].items()))
+        # Most messages share the same versions
+        versions = self.versions.setdefault(versions, versions)
+        report = entry.get('report') or {}
+        self.index[entry['sha1']] = (versions, bool(report.get('triage')), offset)
+
+    def get(self, sha1):
+        """
+            Returns the versions of the analyzers used for the message, and if it was
+            only cleared by the header triage
+        """
+        if sha1 not in self.index:
+            return None
+        versions, triage, offset = self.index[sha1]
+        return {'versions': dict(versions), 'triage': triage}
+
+    def outputs(self, sha1):
+        """
+            Cached module outputs journaled for the message
+        """
+        versions, triage, offset = self.index[sha1]
+        self.reader.seek(offset)
+        return json.loads(self.reader.readline())['outputs']
+
+    def record(self, sha1, versions, report, outputs, error=None):
+        """
+            error is set when the message could not be analysed: it is processed again by the next run
+        """
+        # Cached outputs are module results, which can hold byte strings
+        entry = {'sha1': sha1, 'versions': versions, 'report': report, 'outputs': text(outputs)}
+        if error is not None:
+            entry['error'] = error
+        offset = self.fd.tell()
+        self.fd.write(json.dumps(entry) + '\n')
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        if error is None:
+            self.add(entry, offset)
+
+    def close(self):
+        self.fd.close()
+        self.reader.close()
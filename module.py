@@ -16,17 +16,107 @@ import xml.etree.ElementTree as ET
 import base64
 import zlib
 import hashlib
+import time
+import collections
 import nltk
 import requests
 import magic
 from rblwatch import RBLSearch
 from flanker.addresslib import address
 import rarfile
+import ipaddress
+from email.parser import HeaderParser
+from email.header import decode_header, make_header
 
 
 # We do not want to initialize it twice.
 f = Faup()
 
+# IPv4 or IPv6 literal between brackets, as added by MTAs in Received headers.
+# e.g. "[192.0.2.1]" or "[IPv6:2001:db8::1]"
+received_ip_re = re.compile(r'\[(?:IPv6:)?([0-9A-Fa-f:.]+)\]')
+
+# Non routable (private, loopback, link-local, documentation, multicast...) networks.
+non_public_networks = [ipaddress.ip_network(n) for n in (
+    u'0.0.0.0/8', u'10.0.0.0/8', u'100.64.0.0/10', u'127.0.0.0/8',
+    u'169.254.0.0/16', u'172.16.0.0/12', u'192.0.0.0/24', u'192.0.2.0/24',
+    u'192.168.0.0/16', u'198.18.0.0/15', u'198.51.100.0/24', u'203.0.113.0/24',
+    u'224.0.0.0/4', u'240.0.0.0/4',
+    u'::/128', u'::1/128', u'fc00::/7', u'fe80::/10', u'ff00::/8', u'2001:db8::/32')]
+
+
+def parse_ip(ip):
+    try:
+        return ipaddress.ip_address(unicode(ip))
+    except ValueError:
+        return None
+
+
+def is_public_ip(ip):
+    ip = parse_ip(ip)
+    if ip is None:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    for network in non_public_networks:
+        if ip.version == network.version and ip in network:
+            return False
+    return True
+
+
+def content_hash(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def split_headers(raw):
+    """
+        Return the header block of a raw email, without touching the body
+    """
+    m = re.search(r'\r?\n\r?\n', raw)
+    if m is None:
+        return raw
+    return raw[:m.start()]
+
+
+def decode_header_value(value):
+    """
+        Header value as unicode, with its RFC 2047 encoded words decoded (as flanker does)
+    """
+    if value is None:
+        return None
+    try:
+        return unicode(make_header(decode_header(value)))
+    except Exception:
+        # Unknown charset, undeclared 8 bit text...
+        return value.decode('utf-8', 'replace')
+
+
+suspicious_extensions = (".exe", ".com", ".scr", ".cpl", ".docm",
+                         ".jar", ".pif", ".msi", ".hta", ".msc",
+                         ".bat", ".cmd", ".vbs", ".vbe", ".vb",
+                         ".wsf", ".ws", ".jse", ".js", ".wsc",
+                         ".wsh", ".ps1", ".ps1xml", ".ps2", ".pdf",
+                         ".ps2xml", ".psc1", ".psc2", ".msh",
+                         ".msh1", ".msh2", ".mshxml", ".msh1xml",
+                         ".msh2xml", ".scf", ".lnk", ".inf",
+                         ".reg", ".doc", ".xls", ".ppt", "dll",
+                         ".docm", ".dotm", ".xlsm", ".xltm",
+                         ".xlam", ".pptm", ".potm", ".ppam",
+                         ".ppsm", ".sldm", ".application", ".gadget")
+
+# Files whose content is analysed by the parsers (or may be a nested archive)
+content_extensions = (".doc", ".docx", ".docm", ".dot", ".dotm", ".xls", ".xlsx",
+                      ".xlsm", ".xltm", ".xlam", ".ppt", ".pptx", ".pptm", ".potm",
+                      ".ppam", ".ppsm", ".sldm", ".rtf", ".xml", ".pdf", ".zip",
+                      ".7z", ".rar")
+
+# Extensions used as decoy in front of the real one, e.g. "invoice.pdf.exe"
+decoy_extensions = ("doc", "docx", "xls", "xlsx", "ppt", "pptx", "pdf", "rtf", "txt", "odt",
+                    "jpg", "jpeg", "png", "gif", "bmp", "tif", "tiff", "mp3", "mp4", "avi",
+                    "wav", "zip", "rar", "7z")
+
 
 class EmailAbuseError(Exception):
     def __init__(self, message):
@@ -58,8 +148,46 @@ class ExamineHeaderError(EmailAbuseError):
     pass
 
 
+class LRUCache(object):
+
+    def __init__(self, size=10000, ttl=None):
+        """
+            Keeps the size most recently used entries, for at most ttl seconds (if set)
+        """
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        timestamp, value = entry
+        if self.ttl is not None and time.time() - timestamp > self.ttl:
+            return None
+        # Most recently used last
+        self.entries[key] = entry
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time(), value)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
 class Module(object):
 
+    # Estimated cost of the module, used to schedule the cheap ones first
+    cost = 1
+    # Has to be increased when a change in the module alters its results
+    version = 1
+    # Results shared by all the modules, keyed by cache_key()
+    cache = LRUCache(10000, ttl=24 * 3600)
+
     def __init__(self, name):
         self.name = name
         self.indicators = 0
@@ -74,7 +202,36 @@ class Module(object):
     def result(self):
         raise ImplementationRequired('You have to implement the result method in the module {}'.format(self.name))
 
+    def cache_key(self):
+        """
+            Modules returning a key have their result cached
+        """
+        return None
+
+    def make_key(self, *parts):
+        """
+            Build a cache key including the version of the module, so results of
+            an older version are not reused.
+        """
+        return ':'.join([type(self).__name__, str(self.version)] + [str(p) for p in parts])
+
+    def cacheable(self):
+        """
+            Called after the processing, False if the result must not be cached
+        """
+        return True
+
+    def cached(self):
+        key = self.cache_key()
+        return key is not None and self.cache.get(key) is not None
+
     def processing(self):
+        key = self.cache_key()
+        cached = self.cache.get(key) if key is not None else None
+        if cached is not None:
+            logging.info("{}: using cached result".format(self.name))
+            result, self.indicators = cached
+            return result
         failed = False
         try:
             self._processing()
@@ -85,11 +242,43 @@ class Module(object):
             self.finished()
             if failed:
                 return None
-            return self.result()
+            result = self.result()
+            if key is not None and self.cacheable():
+                self.cache[key] = (result, self.indicators)
+            return result
+
+
+class Scheduler(object):
+
+    def __init__(self, threshold=None):
+        """
+            Runs tasks by increasing cost, stops once the score reaches threshold (if any)
+        """
+        self.threshold = threshold
+        self.tasks = []
+        self.partial = False
+
+    def add(self, cost, task, *args):
+        self.tasks.append((cost, task, args))
+
+    def run(self, score):
+        """
+            score is a callable returning the current indicators
+        """
+        # sorted() is stable: tasks of equal cost keep their insertion order
+        for cost, task, args in sorted(self.tasks, key=lambda t: t[0]):
+            if self.threshold is not None and score() >= self.threshold:
+                logging.info("Scheduler: verdict threshold (%i) reached, skipping remaining tasks" % self.threshold)
+                self.partial = True
+                break
+            task(*args)
+        return self.partial
 
 
 class VirusTotal(Module):
 
+    cost = 100
+
     def __init__(self, payload_hash):
         super(VirusTotal, self).__init__('VirusTotal')
         self.vturl = "https://www.virustotal.com/vtapi/v2/file/report"
@@ -101,6 +290,13 @@ class VirusTotal(Module):
         self.total = 0
         self.vtlink = None
 
+    def cache_key(self):
+        return self.make_key(self.payload_hash)
+
+    def cacheable(self):
+        # VirusTotal may learn about an unknown sample at any time
+        return self.known
+
     def result(self):
         return self.known, self.positives, self.total, self.vtlink
 
@@ -128,6 +324,8 @@ class VirusTotal(Module):
 
 class Tokenizer(Module):
 
+    cost = 10
+
     def __init__(self, content):
         super(Tokenizer, self).__init__('Tokenizer')
         self.content = content
@@ -155,6 +353,8 @@ class Tokenizer(Module):
 
 class ExtractURL(Module):
 
+    cost = 5
+
     def __init__(self, content, origin_domain):
         super(ExtractURL, self).__init__('Extract-URLs')
         self.content = content
@@ -166,6 +366,11 @@ class ExtractURL(Module):
         self.origin_domain = origin_domain
         self.suspicious_urls = []
 
+    def cache_key(self):
+        if self.content is None:
+            return None
+        return self.make_key(content_hash(self.content), self.origin_domain)
+
     def result(self):
         return self.suspicious_urls
 
@@ -188,9 +393,16 @@ class ExtractURL(Module):
 
 class ExamineHeaders(Module):
 
-    def __init__(self, message):
-        super(ExamineHeaders, self).__init__('Header-examination')
+    # Dominated by the RBL lookup
+    cost = 50
+
+    def __init__(self, message, name='Header-examination', rbl=True):
+        """
+            if rbl is False, rbl_lookup() is not called and left to the caller
+        """
+        super(ExamineHeaders, self).__init__(name)
         self.message = message
+        self.rbl = rbl
         self.origin_ip = None
         self.origin_domain = None
         self.rbl_listed = False
@@ -203,15 +415,23 @@ class ExamineHeaders(Module):
     def result(self):
         return self.origin_ip, self.rbl_listed, self.rbl_comment, self.mailfrom, self.mailto, self.origin_domain
 
+    def get_header(self, name):
+        return self.message.headers.get(name)
+
+    def get_received(self):
+        return self.message.headers.getall('Received')
+
     def extract_ip(self, h):
-        m = re.search('\[(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\]', h)
-        if m:
-            ip = m.group(1)
-            logging.info("%s: found IP: %s" % (self.name, ip))
-            return ip
+        for ip in received_ip_re.findall(h):
+            if parse_ip(ip) is not None:
+                logging.info("%s: found IP: %s" % (self.name, ip))
+                return ip
         logging.info("%s: no IP found" % self.name)
 
     def rbl_lookup(self):
+        if parse_ip(self.origin_ip).version != 4:
+            logging.info("%s: no RBL lookup for IPv6 address %s" % (self.name, self.origin_ip))
+            return
         searcher = RBLSearch(self.origin_ip)
         self.result_data = searcher.listed
         if self.result_data:
@@ -228,7 +448,7 @@ class ExamineHeaders(Module):
     def _processing(self):
         recvd_header = []
         try:
-            for x in self.message.headers.getall('Received'):
+            for x in self.get_received():
                 recvd_header.append(x)
             ip = None
         except Exception as e:
@@ -237,28 +457,78 @@ class ExamineHeaders(Module):
             ip = self.extract_ip(h)
             if ip is None:
                 continue
-            if not ip.startswith(("127.", "192.168.", "10.")) \
-                    and not re.search('(^172\.1[6-9]\.)|(^172\.2[0-9]\.)|(^172\.3[0-1]\.)', ip):
+            if is_public_ip(ip):
                 self.origin = h
                 self.origin_ip = ip
                 break
 
-        if self.origin_ip is not None:
+        if self.origin_ip is not None and self.rbl:
             logging.info("%s: Found IP address (%s), passing to module RBL lookup" % (self.name, ip))
             self.rbl_lookup()
 
-        self.mailfrom = self.message.headers.get('From')
-        if email is not None:
+        self.mailfrom = self.get_header('From')
+        if self.mailfrom is not None:
             parsed = address.parse(self.mailfrom)
             if parsed is not None:
                 f.decode(parsed.hostname)
                 self.origin_domain = f.get_domain()
 
-        self.mailto = self.message.headers.get('To')
+        self.mailto = self.get_header('To')
+
+
+class HeaderTriage(ExamineHeaders):
+
+    def __init__(self, raw, threshold=2):
+        """
+            raw is the raw email, only its header block is parsed
+        """
+        message = HeaderParser().parsestr(split_headers(raw), headersonly=True)
+        super(HeaderTriage, self).__init__(message, 'Header-triage')
+        self.threshold = threshold
+        self.sender_domain = None
+        self.domain_mismatch = False
+        self.needs_analysis = False
+
+    def result(self):
+        return self.needs_analysis, self.indicators, self.origin_ip, self.rbl_listed, \
+            self.mailfrom, self.sender_domain, self.origin_domain
+
+    def get_header(self, name):
+        return decode_header_value(self.message.get(name))
+
+    def get_received(self):
+        return self.message.get_all('Received', [])
+
+    def get_domain(self, header):
+        value = self.get_header(header)
+        if value is None:
+            return None
+        parsed = address.parse(value)
+        if parsed is None:
+            return None
+        f.decode(parsed.hostname)
+        return f.get_domain()
+
+    def _processing(self):
+        super(HeaderTriage, self)._processing()
+        self.sender_domain = self.get_domain('Return-Path') or self.get_domain('Sender')
+        if self.sender_domain is not None and self.origin_domain is not None \
+                and self.sender_domain != self.origin_domain:
+            logging.info("%s: envelope sender domain (%s) does not match From domain (%s)"
+                         % (self.name, self.sender_domain, self.origin_domain))
+            self.domain_mismatch = True
+            self.indicators += 1
+        self.needs_analysis = self.indicators >= self.threshold
+        if self.needs_analysis:
+            logging.info("%s: suspicious headers (score: %i), full analysis required" % (self.name, self.indicators))
+        else:
+            logging.info("%s: headers cleared (score: %i)" % (self.name, self.indicators))
 
 
 class ParseOLE(Module):
 
+    cost = 20
+
     def __init__(self, content):
         """
             content has to be a stream in memory
@@ -270,6 +540,11 @@ class ParseOLE(Module):
         self.is_suspicious = False
         self.reason = None
 
+    def cache_key(self):
+        if not isinstance(self.content, basestring):
+            return None
+        return self.make_key(content_hash(self.content))
+
     def result(self):
         return self.is_ole, self.has_parsed, self.is_suspicious, self.reason
 
@@ -311,6 +586,8 @@ class ParseOLE(Module):
 
 class ParsePDF(Module):
 
+    cost = 30
+
     def __init__(self, content):
         super(ParsePDF, self).__init__('Parse-PDF')
         self.content = content
@@ -319,6 +596,9 @@ class ParsePDF(Module):
         self.is_suspicious = False
         self.reason = None
 
+    def cache_key(self):
+        return self.make_key(content_hash(self.content))
+
     def result(self):
         return self.is_pdf, self.has_parsed, self.is_suspicious, self.reason
 
@@ -347,6 +627,8 @@ class ParsePDF(Module):
 
 class ParseOOXML(Module):
 
+    cost = 20
+
     def __init__(self, content):
         super(ParseOOXML, self).__init__('Parse-OOXML')
         self.content = content
@@ -356,6 +638,9 @@ class ParseOOXML(Module):
         self.reason = None
         self.ole_parser = None
 
+    def cache_key(self):
+        return self.make_key(content_hash(self.content))
+
     def result(self):
         return self.is_xml, self.has_parsed, self.is_suspicious, self.reason, self.ole_parser
 
@@ -402,21 +687,17 @@ class ParseOOXML(Module):
 
 class Payload(Module):
 
-    def __init__(self, filename, payload, origin_domain):
+    cost = 200
+
+    def __init__(self, filename, payload, origin_domain, threshold=None, parse=True):
+        """
+            if threshold is set, the analysis stops as soon as the indicators reach it.
+            payload can be set later (on demand decompression), after test_suspicious_extension().
+            If parse is False, the document parsers are not run.
+        """
         super(Payload, self).__init__('Payload')
         self.filename = filename
-        self.suspicious_extensions = (".exe", ".com", ".scr", ".cpl", ".docm",
-                                      ".jar", ".pif", ".msi", ".hta", ".msc",
-                                      ".bat", ".cmd", ".vbs", ".vbe", ".vb",
-                                      ".wsf", ".ws", ".jse", ".js", ".wsc",
-                                      ".wsh", ".ps1", ".ps1xml", ".ps2", ".pdf",
-                                      ".ps2xml", ".psc1", ".psc2", ".msh",
-                                      ".msh1", ".msh2", ".mshxml", ".msh1xml",
-                                      ".msh2xml", ".scf", ".lnk", ".inf",
-                                      ".reg", ".doc", ".xls", ".ppt", "dll",
-                                      ".docm", ".dotm", ".xlsm", ".xltm",
-                                      ".xlam", ".pptm", ".potm", ".ppam",
-                                      ".ppsm", ".sldm", ".application", ".gadget")
+        self.suspicious_extensions = suspicious_extensions
         self.payload = payload
         self.origin_domain = origin_domain
         self.is_suspicious = False
@@ -426,36 +707,110 @@ class Payload(Module):
         self.suspicious_urls = []
         self.parser_results = {}
         self.vt_result = []
-        self.parser_list = [ParsePDF, ParseOLE, ParseOOXML]
+        self.parser_list = [ParsePDF, ParseOLE, ParseOOXML] if parse else []
+        self.parse = parse
+        self.threshold = threshold
+        self.partial = False
+        self.extension_tested = False
+
+    def flag(self, reason):
+        """
+            Mark the payload as suspicious for a reason found outside of it (e.g. archive listing)
+        """
+        self.is_suspicious = True
+        self.reason = reason if self.reason is None else '{}, {}'.format(self.reason.strip(), reason)
 
     def test_suspicious_extension(self):
-        if self.filename.endswith((self.suspicious_extensions)):
+        self.extension_tested = True
+        if self.filename is not None and self.filename.endswith((self.suspicious_extensions)):
             logging.info("%s: Suspicious file detected: '%s'" % (self.name, self.filename))
             self.indicators += 3
-            self.is_suspicious = True
-            self.reason = "is a potentially dangerous file ({}) ".format(self.filename)
+            # Added to the reasons found in the archive listing, if any
+            self.flag("is a potentially dangerous file ({})".format(self.filename))
         else:
             logging.info("%s: no suspicious filenames detected" % self.name)
 
     def result(self):
-        return self.is_suspicious, self.reason, self.mimetype, self.sha1, self.suspicious_urls, self.parser_results, self.vt_result
+        return self.is_suspicious, self.reason, self.mimetype, self.sha1, self.suspicious_urls, \
+            self.parser_results, self.vt_result, self.partial
+
+    def extract_urls(self):
+        extract_urls = ExtractURL(self.payload.getvalue(), self.origin_domain)
+        self.suspicious_urls = extract_urls.processing()
+        self.indicators += extract_urls.indicators
+
+    def vt_lookup(self, vt):
+        self.vt_result = vt.processing()
+        self.indicators += vt.indicators
+
+    def run_parser(self, parser):
+        p = parser(self.payload.getvalue())
+        self.parser_results[type(p).__name__] = p.processing()
+        self.indicators += p.indicators
 
     def _processing(self):
-        self.test_suspicious_extension()
+        # Usually done beforehand, without the content
+        if not self.extension_tested:
+            self.test_suspicious_extension()
+        # The hash is required for the lookups
         h = hashlib.sha1()
         h.update(self.payload.getvalue())
         self.sha1 = h.hexdigest()
         self.mimetype = magic.from_buffer(self.payload.getvalue())
-        extract_urls = ExtractURL(self.payload.getvalue(), self.origin_domain)
-        self.suspicious_urls = extract_urls.processing()
-        self.indicators += extract_urls.indicators
+
+        scheduler = Scheduler(self.threshold)
+        scheduler.add(ExtractURL.cost, self.extract_urls)
         vt = VirusTotal(self.sha1)
-        self.vt_result = vt.processing()
-        self.indicators += vt.indicators
+        scheduler.add(0 if vt.cached() else vt.cost, self.vt_lookup, vt)
         for parser in self.parser_list:
-            p = parser(self.payload.getvalue())
-            self.parser_results[type(p).__name__] = p.processing()
-            self.indicators += p.indicators
+            scheduler.add(parser.cost, self.run_parser, parser)
+        self.partial = scheduler.run(lambda: self.indicators)
+
+
+class ArchiveTriage(Module):
+
+    # Cheaper than the remote lookups, but listing a RAR archive with encrypted
+    # headers needs the password list, fed by the tokenizers.
+    cost = 15
+
+    def __init__(self, members, max_ratio=100):
+        """
+            members is the listing of an archive (see Archive.result), nothing is decompressed
+        """
+        super(ArchiveTriage, self).__init__('Archive-triage')
+        self.members = members
+        self.max_ratio = max_ratio
+        self.verdicts = {}
+
+    def result(self):
+        return self.verdicts
+
+    def _processing(self):
+        for member in self.members:
+            name = member['name']
+            lname = name.lower()
+            if lname.endswith('/'):
+                # directory
+                continue
+            reasons = []
+            # Documents and nested archives are worth parsing, the others (executables, scripts...)
+            # only need to be hashed and looked up.
+            # The extension itself is scored by Payload.test_suspicious_extension
+            needs_content = lname.endswith(content_extensions) or not lname.endswith(suspicious_extensions)
+            parts = os.path.basename(lname).split('.')
+            if len(parts) > 2 and parts[-2] in decoy_extensions and lname.endswith(suspicious_extensions):
+                self.indicators += 1
+                reasons.append("has a double extension")
+            if member['encrypted']:
+                self.indicators += 1
+                reasons.append("is encrypted")
+            if member['compressed_size'] and member['size'] \
+                    and member['size'] / member['compressed_size'] > self.max_ratio:
+                self.indicators += 2
+                reasons.append("has a suspicious compression ratio ({} / {})".format(member['size'], member['compressed_size']))
+            if reasons:
+                logging.info("%s: '%s' %s" % (self.name, name, ', '.join(reasons)))
+            self.verdicts[name] = (len(reasons) > 0, ', '.join(reasons) or None, needs_content)
 
 
 class Archive(Module):
@@ -467,10 +822,38 @@ class Archive(Module):
         self.password_protected = False
         self.password_found = False
         self.passwordlist = passwordlist
+        self.members = []
         self.unpacked_files = {}
 
     def result(self):
-        return self.unpacked_files
+        return self.members
+
+    def add_member(self, name, size, compressed_size, encrypted):
+        self.members.append({'name': name, 'size': size, 'compressed_size': compressed_size,
+                             'encrypted': encrypted})
+
+    def _extract(self, subfile):
+        raise ImplementationRequired('You have to implement the _extract method in the module {}'.format(self.name))
+
+    def extract(self, subfile):
+        """
+            Decompress a single member, on demand.
+            Returns an in-memory file, or None if it cannot be unpacked.
+        """
+        if subfile not in self.unpacked_files:
+            try:
+                self.unpacked_files[subfile] = self._extract(subfile)
+            except Exception as e:
+                logging.exception(e)
+                self.unpacked_files[subfile] = None
+        return self.unpacked_files[subfile]
+
+    def close(self):
+        try:
+            if self.archive is not None and hasattr(self.archive, 'close'):
+                self.archive.close()
+        finally:
+            self.pseudofile.close()
 
 
 class ArchiveZip(Archive):
@@ -481,39 +864,39 @@ class ArchiveZip(Archive):
 
     def _processing(self):
         self.archive = zipfile.ZipFile(self.pseudofile)
-        if self.archive is not None and self.archive.namelist() is not None:
-            logging.info("%s: Found a valid zip archive" % self.name)
-            for subfile in self.archive.namelist():
-                self.unpacked_files[subfile] = None
-                if self.password_protected and not self.password_found:
-                    logging.info("%s: encrypted file '%s' and unable to find the password." % (self.name, subfile))
-                    break
-                try:
-                    logging.info("%s: Trying to extract %s from archive" % (self.name, subfile))
-                    self.unpacked_files[subfile] = StringIO.StringIO(self.archive.open(subfile).read())
-                    logging.info("%s: successfully unpacked file '%s'" % (self.name, subfile))
-                except Exception as e:
-                    if "encrypted" in str(e):
-                        self.password_protected = True
-                        logging.info("%s: encrypted file '%s' found in archive" % (self.name, subfile))
-                    else:
-                        raise ArchiveError(e)
-                    for pw in self.passwordlist:
-                        self.archive.setpassword(pw)
-                        try:
-                            self.unpacked_files[subfile] = StringIO.StringIO(self.archive.open(subfile).read())
-                            self.password_found = True
-                            logging.info("%s: found password: %s" % (self.name, pw))
-                            break
-                        except Exception as e:
-                            if "Bad password" in str(e):
-                                logging.info("%s: error: %s while trying password '%s'" % (self.name, e, pw))
-                            elif "encrypted" in str(e):
-                                continue
-                            else:
-                                raise ArchiveError(e)
-            self.archive.close()
-            self.pseudofile.close()
+        logging.info("%s: Found a valid zip archive" % self.name)
+        for info in self.archive.infolist():
+            self.add_member(info.filename, info.file_size, info.compress_size, bool(info.flag_bits & 0x1))
+
+    def _extract(self, subfile):
+        if self.password_protected and not self.password_found:
+            logging.info("%s: encrypted file '%s' and unable to find the password." % (self.name, subfile))
+            return None
+        try:
+            logging.info("%s: Trying to extract %s from archive" % (self.name, subfile))
+            content = StringIO.StringIO(self.archive.open(subfile).read())
+            logging.info("%s: successfully unpacked file '%s'" % (self.name, subfile))
+            return content
+        except Exception as e:
+            if "encrypted" in str(e):
+                self.password_protected = True
+                logging.info("%s: encrypted file '%s' found in archive" % (self.name, subfile))
+            else:
+                raise ArchiveError(e)
+        for pw in self.passwordlist:
+            self.archive.setpassword(pw)
+            try:
+                content = StringIO.StringIO(self.archive.open(subfile).read())
+                self.password_found = True
+                logging.info("%s: found password: %s" % (self.name, pw))
+                return content
+            except Exception as e:
+                if "Bad password" in str(e):
+                    logging.info("%s: error: %s while trying password '%s'" % (self.name, e, pw))
+                elif "encrypted" in str(e):
+                    continue
+                else:
+                    raise ArchiveError(e)
 
 
 class Archive7z(Archive):
@@ -524,37 +907,40 @@ class Archive7z(Archive):
     def _processing(self):
         self.pseudofile.seek(0)
         self.archive = py7zlib.Archive7z(self.pseudofile)
-        if self.archive is not None and self.archive.getnames() is not None:
-            logging.info("%s: Found a valid 7z archive" % self.name)
-            for subfile in self.archive.getnames():
-                self.unpacked_files[subfile] = None
-                if self.password_protected and not self.password_found:
-                    logging.info("%s: encrypted file '%s' and unable to find the password." % (self.name, subfile))
-                    break
-                try:
-                    logging.info("%s: Trying to extract %s from archive" % (self.name, subfile))
-                    self.unpacked_files[subfile] = StringIO.StringIO(self.archive.getmember(subfile).read())
-                    logging.info("%s: successfully unpacked file '%s'" % (self.name, subfile))
-                except py7zlib.NoPasswordGivenError as e:
-                    self.password_protected = True
-                    logging.info("%s: Archive is password protected" % self.name)
-                    for pw in self.passwordlist:
-                        try:
-                            self.pseudofile.seek(0)
-                            self.archive = py7zlib.Archive7z(self.pseudofile, password=pw)
-                            self.unpacked_files[subfile] = self.archive.getmember(subfile).read()
-                            self.password_found = True
-                            logging.info("%s: found password: %s" % (self.name, pw))
-                            break
-                        except py7zlib.WrongPasswordError as e:
-                            logging.info("%s: error: %s while trying password '%s'" % (self.name, e, pw))
-                        except py7zlib.NoPasswordGivenError:
-                            continue
-                        except Exception as e:
-                            raise ArchiveError(type(e))
-                except Exception as e:
-                    raise ArchiveError(type(e))
-            self.pseudofile.close()
+        logging.info("%s: Found a valid 7z archive" % self.name)
+        for member in self.archive.getmembers():
+            encrypted = member._is_encrypted() if hasattr(member, '_is_encrypted') else False
+            self.add_member(member.filename, member.size, getattr(member, 'compressed', None), encrypted)
+
+    def _extract(self, subfile):
+        if self.password_protected and not self.password_found:
+            logging.info("%s: encrypted file '%s' and unable to find the password." % (self.name, subfile))
+            return None
+        try:
+            logging.info("%s: Trying to extract %s from archive" % (self.name, subfile))
+            content = StringIO.StringIO(self.archive.getmember(subfile).read())
+            logging.info("%s: successfully unpacked file '%s'" % (self.name, subfile))
+            return content
+        except py7zlib.NoPasswordGivenError as e:
+            self.password_protected = True
+            logging.info("%s: Archive is password protected" % self.name)
+        except Exception as e:
+            raise ArchiveError(type(e))
+        for pw in self.passwordlist:
+            try:
+                self.pseudofile.seek(0)
+                archive = py7zlib.Archive7z(self.pseudofile, password=pw)
+                content = StringIO.StringIO(archive.getmember(subfile).read())
+                self.archive = archive
+                self.password_found = True
+                logging.info("%s: found password: %s" % (self.name, pw))
+                return content
+            except py7zlib.WrongPasswordError as e:
+                logging.info("%s: error: %s while trying password '%s'" % (self.name, e, pw))
+            except py7zlib.NoPasswordGivenError:
+                continue
+            except Exception as e:
+                raise ArchiveError(type(e))
 
 
 class ArchiveRAR(Archive):
@@ -563,38 +949,44 @@ class ArchiveRAR(Archive):
         super(ArchiveRAR, self).__init__('Archive-rar', pseudofile, passwordlist)
 
     def _processing(self):
+        # Only reads the headers, unrar is called when a member is extracted
         self.archive = rarfile.RarFile(self.pseudofile)
-        if self.archive is not None:
-            if self.archive.needs_password():
-                self.password_protected = True
-                logging.info("%s: Archive is password protected" % self.name)
-                for pw in self.passwordlist:
-                    print pw
-                    try:
-                        self.archive.setpassword(pw)
-                        self.password_found = True
-                        logging.info("%s: found password: %s" % (self.name, pw))
-                        break
-                    except Exception as e:
-                        logging.info("%s: error: %s while trying password '%s'" % (self.name, e, pw))
-                        # This is somehow needed.
-                        self.archive.close()
-                        self.archive = rarfile.RarFile(self.pseudofile)
-            if self.password_protected and not self.password_found:
-                # Have to change the messsage: the file list is unknown, so no subfile
-                logging.info("%s: encrypted file and unable to find the password." % (self.name))
-                return
-            print self.archive.infolist()
-            for f in self.archive.infolist():
-                subfile = f.filename
-                print subfile
-                self.unpacked_files[subfile] = None
+        if self.archive.needs_password():
+            self.password_protected = True
+            logging.info("%s: Archive is password protected" % self.name)
+            for pw in self.passwordlist:
                 try:
-                    logging.info("%s: Trying to extract %s from archive" % (self.name, subfile))
-                    # FIXME: cannot work: https://github.com/markokr/rarfile/blob/9c7ce20a00384cf237e66c2f46effdd94f8d4ca6/rarfile.py#L1189
-                    self.unpacked_files[subfile] = self.archive.read(f)
-                    logging.info("%s: successfully unpacked file '%s'" % (self.name, subfile))
+                    self.archive.setpassword(pw)
+                    self.password_found = True
+                    logging.info("%s: found password: %s" % (self.name, pw))
+                    break
                 except Exception as e:
-                    raise ArchiveError(e)
-            self.archive.close()
-            self.pseudofile.close()
+                    logging.info("%s: error: %s while trying password '%s'" % (self.name, e, pw))
+                    # This is somehow needed.
+                    self.archive.close()
+                    self.archive = rarfile.RarFile(self.pseudofile)
+        if self.password_protected and not self.password_found:
+            # Have to change the messsage: the file list is unknown, so no subfile
+            logging.info("%s: encrypted file and unable to find the password." % (self.name))
+            return
+        for f in self.archive.infolist():
+            self.add_member(f.filename, f.file_size, f.compress_size, f.needs_password())
+
+    def _extract(self, subfile):
+        logging.info("%s: Trying to extract %s from archive" % (self.name, subfile))
+        try:
+            # FIXME: cannot work: https://github.com/markokr/rarfile/blob/9c7ce20a00384cf237e66c2f46effdd94f8d4ca6/rarfile.py#L1189
+            content = StringIO.StringIO(self.archive.read(subfile))
+        except Exception as e:
+            raise ArchiveError(e)
+        logging.info("%s: successfully unpacked file '%s'" % (self.name, subfile))
+        return content
+
+
+# Modules whose version is recorded in the batch journal
+analyzers = [ExamineHeaders, HeaderTriage, ExtractURL, Tokenizer, VirusTotal, ParseOLE,
+             ParsePDF, ParseOOXML, Payload, ArchiveTriage, ArchiveZip, Archive7z, ArchiveRAR]
+
+
+def analyzer_versions():
+    return dict((a.__name__, a.version) for a in analyzers)
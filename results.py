@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+try:
+    import msgpack
+except ImportError:
+    # Only required by the msgpack output
+    msgpack = None
+
+
+def text(value):
+    """
+        Byte strings (raw headers, archive member names, URLs found in binary payloads...)
+        decoded to unicode, invalid bytes replaced. Lists, tuples and dicts are converted recursively.
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (list, tuple)):
+        return [text(v) for v in value]
+    if isinstance(value, dict):
+        return dict((text(k), text(v)) for k, v in value.items())
+    return value
+
+
+class Record(object):
+    """
+        Compact result record. Fields holding records (or lists of records)
+        are listed in nested, to be rebuilt by from_dict().
+        Text fields always hold unicode, whatever the analyzers returned.
+    """
+    __slots__ = ()
+    nested = {}
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def __setattr__(self, name, value):
+        super(Record, self).__setattr__(name, text(value))
+
+    def to_dict(self):
+        d = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, Record):
+                value = value.to_dict()
+            elif isinstance(value, list):
+                value = [v.to_dict() if isinstance(v, Record) else v for v in value]
+            d[name] = value
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        kwargs = dict(d)
+        for name, record in cls.nested.items():
+            value = kwargs.get(name)
+            if isinstance(value, list):
+                kwargs[name] = [record.from_dict(v) for v in value]
+            elif value is not None:
+                kwargs[name] = record.from_dict(value)
+        return cls(**kwargs)
+
+
+class ParserVerdict(Record):
+    __slots__ = ('parser', 'matched', 'parsed', 'suspicious', 'reason')
+
+    @classmethod
+    def from_result(cls, parser, result):
+        """
+            result is the tuple returned by ParseOLE/ParsePDF/ParseOOXML
+        """
+        if result is None:
+            return cls(parser=parser, matched=False, parsed=False, suspicious=False)
+        return cls(parser=parser, matched=result[0], parsed=result[1], suspicious=result[2], reason=result[3])
+
+
+class PayloadResult(Record):
+    __slots__ = ('filename', 'attachment', 'suspicious', 'reason', 'mimetype', 'sha1', 'suspicious_urls',
+                 'parsers', 'vt_known', 'vt_positives', 'vt_total', 'vt_link', 'partial')
+    nested = {'parsers': ParserVerdict}
+
+    @classmethod
+    def from_result(cls, filename, attachment, result):
+        """
+            result is the tuple returned by Payload
+        """
+        if result is None:
+            return cls(filename=filename, attachment=attachment, suspicious=False, suspicious_urls=[],
+                       parsers=[], vt_known=False, partial=False)
+        is_suspicious, reason, mimetype, sha1, suspicious_urls, parser_results, vt_result, partial = result
+        parsers = [ParserVerdict.from_result(parser, r) for parser, r in sorted(parser_results.items())]
+        vt_known, vt_positives, vt_total, vt_link = vt_result or (False, None, None, None)
+        return cls(filename=filename, attachment=attachment, suspicious=is_suspicious, reason=reason,
+                   mimetype=mimetype, sha1=sha1, suspicious_urls=list(suspicious_urls or []), parsers=parsers,
+                   vt_known=vt_known, vt_positives=vt_positives, vt_total=vt_total, vt_link=vt_link,
+                   partial=partial)
+
+
+class MessageResult(Record):
+    __slots__ = ('msg_file', 'path', 'subject', 'origin_ip', 'mailfrom', 'mailto', 'rbl_comment',
+                 'attachments', 'payloads', 'suspicious_urls', 'indicators', 'partial', 'triage')
+    nested = {'payloads': PayloadResult}
+
+    @classmethod
+    def from_triage(cls, triage):
+        """
+            triage is a HeaderTriage module which cleared the message: only its headers were analysed
+        """
+        return cls(subject=triage.get_header('Subject'), origin_ip=triage.origin_ip, mailfrom=triage.mailfrom,
+                   mailto=triage.mailto, rbl_comment=triage.rbl_comment, attachments=[], payloads=[],
+                   suspicious_urls=[], indicators=triage.indicators, partial=False, triage=True)
+
+
+def write_ndjson(result, fd):
+    """
+        One line per message, flushed right away so the output can be consumed live
+    """
+    fd.write(json.dumps(result.to_dict(), separators=(',', ':')) + '\n')
+    fd.flush()
+
+
+def write_msgpack(result, fd):
+    """
+        Stream of msgpack maps, to be read back with msgpack.Unpacker
+    """
+    if msgpack is None:
+        raise ImportError('msgpack is required for the msgpack output')
+    fd.write(msgpack.packb(result.to_dict()))
+    fd.flush()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from module import Scheduler
+    from emailabuse import analyse_payloads
+except ImportError:
+    # The analyzers dependencies (see requirements.txt) are not installed
+    Scheduler = analyse_payloads = None
+
+
+class FakePayload(object):
+    """
+        Stands for a Payload module: scores its tasks until its own indicators reach its threshold
+    """
+
+    def __init__(self, scores, indicators=0, filename=None, parse=True):
+        self.filename = filename
+        self.payload = None if filename else 'content'
+        self.parse = parse
+        self.scores = scores
+        self.indicators = indicators
+        self.threshold = None
+        self.partial = False
+        self.run = []
+
+    def add(self, score):
+        self.run.append(score)
+        self.indicators += score
+
+    def processing(self):
+        scheduler = Scheduler(self.threshold)
+        for score in self.scores:
+            scheduler.add(1, self.add, score)
+        self.partial = scheduler.run(lambda: self.indicators)
+
+
+class FakeArchive(object):
+
+    def __init__(self):
+        self.extracted = []
+
+    def extract(self, name):
+        self.extracted.append(name)
+        return 'content'
+
+
+@unittest.skipIf(Scheduler is None, 'analyzers dependencies missing')
+class SchedulerTest(unittest.TestCase):
+
+    def test_cost_order(self):
+        run = []
+        scheduler = Scheduler()
+        scheduler.add(50, run.append, 'rbl')
+        scheduler.add(5, run.append, 'urls')
+        scheduler.add(15, run.append, 'triage')
+        scheduler.add(5, run.append, 'urls2')
+        self.assertFalse(scheduler.run(lambda: 0))
+        self.assertEqual(run, ['urls', 'urls2', 'triage', 'rbl'])
+
+    def test_threshold(self):
+        score = []
+        scheduler = Scheduler(3)
+        for cost in (1, 2, 3, 4):
+            scheduler.add(cost, score.append, 2)
+        self.assertTrue(scheduler.run(lambda: sum(score)))
+        self.assertEqual(score, [2, 2])
+
+
+@unittest.skipIf(analyse_payloads is None, 'analyzers dependencies missing')
+class AnalysePayloadsTest(unittest.TestCase):
+
+    def test_no_threshold(self):
+        payloads = [FakePayload([1, 1]), FakePayload([2])]
+        self.assertEqual(analyse_payloads(None, payloads), (4, False))
+
+    def test_triage_score_not_counted_twice(self):
+        # .exe attachment: +3 from the file name, already counted by the triage.
+        # Stopping at 5, the triage leaves 2 to the payloads.
+        payload = FakePayload([1, 1, 1], indicators=3)
+        indicators, partial = analyse_payloads(None, [payload], 2)
+        self.assertEqual(payload.run, [1, 1])
+        self.assertEqual(indicators, 2)
+        self.assertTrue(partial)
+
+    def test_threshold_reached(self):
+        payloads = [FakePayload([3]), FakePayload([1])]
+        indicators, partial = analyse_payloads(None, payloads, 2)
+        self.assertEqual(indicators, 3)
+        self.assertTrue(partial)
+        self.assertEqual(payloads[1].run, [])
+        self.assertTrue(payloads[1].partial)
+
+    def test_members_extraction(self):
+        archive = FakeArchive()
+        payloads = [FakePayload([1], filename='report.doc'), FakePayload([2], filename='setup.exe', parse=False)]
+        self.assertEqual(analyse_payloads(archive, payloads), (1, False))
+        # Scored by name, not decompressed
+        self.assertEqual(archive.extracted, ['report.doc'])
+        self.assertEqual(payloads[1].payload, None)
+        archive = FakeArchive()
+        payloads = [FakePayload([1], filename='report.doc'), FakePayload([2], filename='setup.exe', parse=False)]
+        self.assertEqual(analyse_payloads(archive, payloads, lookup_members=True), (3, False))
+        self.assertEqual(archive.extracted, ['report.doc', 'setup.exe'])
+
+
+if __name__ == '__main__':
+    unittest.main()
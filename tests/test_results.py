@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from results import MessageResult, PayloadResult, ParserVerdict, text
+
+
+class RecordTextTest(unittest.TestCase):
+
+    def test_text(self):
+        self.assertEqual(text(b'caf\xc3\xa9'), u'caf\xe9')
+        self.assertEqual(text(b'caf\xe9'), u'caf�')
+        self.assertEqual(text((b'a', [b'b'], {b'c': 1})), [u'a', [u'b'], {u'c': 1}])
+        self.assertEqual(text(3), 3)
+        self.assertEqual(text(None), None)
+
+    def test_fields_decoded(self):
+        payload = PayloadResult.from_result(b'facture\xe9.zip', b'caf\xe9.zip', (
+            True, b'is encrypted', 'Zip archive data', 'da39a3ee', [b'http://example.com/\xff'],
+            {'ParseOLE': (True, False, True, b'Non-fatal parsing issue: \xff')}, None, False))
+        result = MessageResult(subject=b'caf\xe9', mailfrom=u'a@example.com', attachments=[], payloads=[payload],
+                               suspicious_urls=[b'http://example.com/\xe9'], indicators=3)
+        result.attachments.append(text([b'caf\xe9.zip', 'application/zip']))
+        self.assertEqual(result.subject, u'caf�')
+        self.assertEqual(payload.filename, u'facture�.zip')
+        self.assertEqual(payload.suspicious_urls, [u'http://example.com/�'])
+        self.assertEqual(payload.parsers[0].reason, u'Non-fatal parsing issue: �')
+        self.assertEqual(result.indicators, 3)
+        # Serializable, and read back as is
+        report = json.loads(json.dumps(result.to_dict()))
+        self.assertEqual(MessageResult.from_dict(report).to_dict(), result.to_dict())
+
+    def test_parser_verdict(self):
+        verdict = ParserVerdict.from_result('ParsePDF', None)
+        self.assertEqual((verdict.matched, verdict.reason), (False, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workqueue import MemoryBroker, SQLiteBroker, shard_key, get_shard
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class BrokerTests(object):
+    """
+        Run against each broker by the TestCase classes below
+    """
+
+    def make_broker(self, **kwargs):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.clock = Clock()
+        self.broker = self.make_broker(lease_timeout=10, max_attempts=3, retry_delay=5)
+        self.broker.clock = self.clock
+
+    def test_lease_complete(self):
+        self.broker.enqueue('a', 0)
+        job = self.broker.lease('w1')
+        self.assertEqual(job['ref'], 'a')
+        self.assertEqual(job['attempts'], 1)
+        self.assertEqual(self.broker.lease('w2'), None)
+        self.assertTrue(self.broker.complete(job['id'], 'w1', {'subject': 'x'}))
+        self.assertEqual(list(self.broker.results()), [('a', {'subject': 'x'})])
+        self.assertEqual(self.broker.counts(), {'done': 1})
+
+    def test_enqueue_twice(self):
+        self.broker.enqueue('a', 0)
+        self.broker.enqueue('a', 0)
+        self.assertEqual(self.broker.counts(), {'queued': 1})
+
+    def test_lease_expiry(self):
+        self.broker.enqueue('a', 0)
+        job = self.broker.lease('w1')
+        self.clock.now += 5
+        self.assertEqual(self.broker.lease('w2'), None)
+        self.clock.now += 6
+        job2 = self.broker.lease('w2')
+        self.assertEqual(job2['ref'], 'a')
+        self.assertEqual(job2['attempts'], 2)
+        # The stale lease holder result is dropped
+        self.assertFalse(self.broker.complete(job['id'], 'w1', {'worker': 'w1'}))
+        self.assertFalse(self.broker.fail(job['id'], 'w1', 'error'))
+        self.assertTrue(self.broker.complete(job2['id'], 'w2', {'worker': 'w2'}))
+        self.assertEqual(list(self.broker.results()), [('a', {'worker': 'w2'})])
+
+    def test_extend(self):
+        self.broker.enqueue('a', 0)
+        job = self.broker.lease('w1')
+        self.clock.now += 8
+        self.assertTrue(self.broker.extend(job['id'], 'w1'))
+        self.clock.now += 8
+        self.assertEqual(self.broker.lease('w2'), None)
+        self.assertFalse(self.broker.extend(job['id'], 'w2'))
+        self.assertTrue(self.broker.complete(job['id'], 'w1', {}))
+
+    def test_lease_expired_max_attempts(self):
+        self.broker.enqueue('a', 0)
+        for attempt in range(3):
+            self.assertEqual(self.broker.lease('w1')['attempts'], attempt + 1)
+            self.clock.now += 11
+        self.assertEqual(self.broker.lease('w1'), None)
+        self.assertEqual(self.broker.counts(), {'failed': 1})
+
+    def test_fail_backoff(self):
+        self.broker.enqueue('a', 0)
+        job = self.broker.lease('w1')
+        self.assertTrue(self.broker.fail(job['id'], 'w1', 'error'))
+        self.assertEqual(self.broker.lease('w1'), None)
+        self.clock.now += 5
+        job = self.broker.lease('w1')
+        self.assertEqual(job['attempts'], 2)
+        self.assertTrue(self.broker.fail(job['id'], 'w1', 'error'))
+        # Doubled
+        self.clock.now += 5
+        self.assertEqual(self.broker.lease('w1'), None)
+        self.clock.now += 5
+        job = self.broker.lease('w1')
+        self.assertEqual(job['attempts'], 3)
+        self.assertTrue(self.broker.fail(job['id'], 'w1', 'error'))
+        self.clock.now += 100
+        self.assertEqual(self.broker.lease('w1'), None)
+        self.assertEqual(self.broker.counts(), {'failed': 1})
+
+    def test_shard_preference(self):
+        self.broker.enqueue('a', 0)
+        self.broker.enqueue('b', 1)
+        self.broker.enqueue('c', 1)
+        self.assertEqual(self.broker.lease('w1', [1])['ref'], 'b')
+        self.assertEqual(self.broker.lease('w1', [1])['ref'], 'c')
+        # Nothing left in its shards
+        self.assertEqual(self.broker.lease('w1', [1])['ref'], 'a')
+        self.assertEqual(self.broker.lease('w1', [1]), None)
+
+
+class MemoryBrokerTest(BrokerTests, unittest.TestCase):
+
+    def make_broker(self, **kwargs):
+        return MemoryBroker(**kwargs)
+
+
+class SQLiteBrokerTest(BrokerTests, unittest.TestCase):
+
+    def make_broker(self, **kwargs):
+        self.tmp = tempfile.mkdtemp()
+        return SQLiteBroker(os.path.join(self.tmp, 'queue.db'), **kwargs)
+
+    def tearDown(self):
+        self.broker.db.close()
+        shutil.rmtree(self.tmp)
+
+
+class ShardKeyTest(unittest.TestCase):
+
+    message = (b'From: a@example.com\n'
+               b'Content-Type: multipart/mixed; boundary="XX"\n'
+               b'\n'
+               b'--XX\n'
+               b'Content-Type: text/plain\n'
+               b'\n'
+               b'{text}\n'
+               b'--XX\n'
+               b'Content-Type: application/zip; name="a.zip"\n'
+               b'Content-Disposition: attachment; filename="a.zip"\n'
+               b'\n'
+               b'UEsDBAoAAAAAAA\n'
+               b'AAAAAA==\n'
+               b'--XX--\n')
+
+    def test_same_attachment(self):
+        first = shard_key(self.message.replace(b'{text}', b'first'))
+        second = shard_key(self.message.replace(b'{text}', b'second').replace(b'\n', b'\r\n'))
+        self.assertEqual(first, second)
+
+    def test_no_attachment(self):
+        self.assertNotEqual(shard_key(b'Subject: first\n\nfirst'), shard_key(b'Subject: second\n\nsecond'))
+
+    def test_get_shard(self):
+        self.assertTrue(0 <= get_shard(shard_key(b'Subject: x\n\nx'), 4) < 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import json
+import signal
+import logging
+import threading
+import multiprocessing
+try:
+    import pyinotify
+except ImportError:
+    # Not available (or not on Linux): fallback to polling
+    pyinotify = None
+
+
+logger = logging.getLogger('watcher')
+
+
+def init_worker():
+    """
+        Ctrl-C is for the watcher, which lets the workers finish their messages.
+        Workers forked to replace others inherit the SIGTERM handler of the watcher.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def process_file(path, stop_at, triage, lookup_members):
+    """
+        Runs in a worker process
+    """
+    start = time.time()
+    try:
+        from emailabuse import analyse_raw
+        with open(path, 'rb') as fp:
+            raw = fp.read()
+        result = analyse_raw(raw, stop_at, triage, lookup_members)
+        result.path = path
+        report = result.to_dict()
+        return path, report, None, time.time() - start
+    except Exception as e:
+        logging.exception(e)
+        return path, None, str(e), time.time() - start
+
+
+class SpoolWatcher(object):
+
+    def __init__(self, spool, done=None, workers=4, max_queue=None, stop_at=None, triage=None,
+                 poll_interval=1, stats_interval=60, results=None, max_tasks=1000, lookup_members=False):
+        """
+            Analyse the files landing in spool as soon as they are there.
+            spool can be the new/ directory of a Maildir, processed messages are then moved to cur/
+            and their results written next to the Maildir, cur/ only holding messages.
+            At most max_queue files are waiting or being processed at any time.
+            stop_at, triage and lookup_members are passed to analyse_raw().
+            Workers are replaced after max_tasks messages, releasing what they accumulated
+            (module cache, parser leaks) on a long running watch.
+        """
+        self.spool = os.path.abspath(spool)
+        parent, name = os.path.split(self.spool)
+        self.maildir = name == 'new' and os.path.isdir(os.path.join(parent, 'cur'))
+        if done is not None:
+            self.done = done
+        elif self.maildir:
+            self.done = os.path.join(parent, 'cur')
+        else:
+            self.done = os.path.join(self.spool, 'done')
+        if results is not None:
+            self.results = results
+        elif self.maildir:
+            self.results = os.path.normpath(parent) + '.results'
+        else:
+            self.results = self.done
+        for directory in (self.done, self.results):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        self.workers = workers
+        self.max_tasks = max_tasks
+        self.stop_at = stop_at
+        self.triage = triage
+        self.lookup_members = lookup_members
+        self.poll_interval = poll_interval
+        self.stats_interval = stats_interval
+        self.slots = threading.BoundedSemaphore(max_queue or workers * 2)
+        self.lock = threading.Lock()
+        self.pending = set()
+        # Messages which could not be moved out of the spool, not submitted again
+        self.stuck = set()
+        self.pool = None
+        self.started = None
+        self.stopped = threading.Event()
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0.
+
+    def backlog(self):
+        """
+            Messages in the spool, submitted or not
+        """
+        count = 0
+        for fn in os.listdir(self.spool):
+            if not fn.startswith('.') and os.path.isfile(os.path.join(self.spool, fn)):
+                count += 1
+        return count
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        backlog = self.backlog()
+        with self.lock:
+            done = self.processed + self.failed
+            return {'processed': self.processed, 'failed': self.failed,
+                    'queue_depth': backlog, 'in_flight': len(self.pending),
+                    'throughput': done / elapsed if elapsed > 0 else 0.,
+                    'avg_time': self.busy_time / done if done > 0 else 0.,
+                    # Share of the worker time spent analysing: close to 1, more workers are needed
+                    'utilization': self.busy_time / (elapsed * self.workers) if elapsed > 0 else 0.}
+
+    def report_stats(self):
+        stats = self.stats()
+        stats['utilization'] *= 100
+        logger.info("processed: %(processed)i, failed: %(failed)i, queue depth: %(queue_depth)i "
+                    "(%(in_flight)i submitted), throughput: %(throughput).2f msg/s, "
+                    "average time: %(avg_time).2fs, workers utilization: %(utilization).0f%%" % stats)
+
+    def stats_loop(self):
+        """
+            In its own thread: the main one blocks while the queue is full
+        """
+        while not self.stopped.wait(self.stats_interval):
+            try:
+                self.report_stats()
+            except Exception as e:
+                logger.exception(e)
+
+    def done_path(self, path):
+        fn = os.path.basename(path)
+        if self.maildir and ':2,' not in fn:
+            fn += ':2,'
+        return os.path.join(self.done, fn)
+
+    def results_path(self, path):
+        return os.path.join(self.results, os.path.basename(path) + '.json')
+
+    def submit(self, path):
+        if os.path.basename(path).startswith('.'):
+            return
+        with self.lock:
+            # Checked under the lock: a message leaves pending once moved out of the spool
+            if path in self.pending or path in self.stuck or not os.path.isfile(path):
+                return
+            self.pending.add(path)
+        # Blocks as long as the queue is full, a blocking acquire() cannot be interrupted on python 2
+        while not self.slots.acquire(False):
+            time.sleep(0.1)
+        self.pool.apply_async(process_file, (path, self.stop_at, self.triage, self.lookup_members),
+                              callback=self.finished)
+
+    def finished(self, result):
+        """
+            Called in the result thread of the pool
+        """
+        path, report, error, duration = result
+        with self.lock:
+            self.busy_time += duration
+        try:
+            if report is None:
+                # Moved out of the spool as well, it would be retried forever otherwise
+                logger.info("failed to analyse %s: %s" % (path, error))
+                report = {'error': error}
+            self.move(path, report)
+            with self.lock:
+                if error is None:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+        except Exception as e:
+            logger.exception(e)
+            with self.lock:
+                self.failed += 1
+            self.discard(path, str(e))
+        finally:
+            with self.lock:
+                self.pending.discard(path)
+            self.slots.release()
+
+    def move(self, path, report):
+        results = self.results_path(path)
+        # Write the results first, then move the message: a crash in between leaves it in the spool.
+        tmp = results + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(report, fp)
+        os.rename(tmp, results)
+        os.rename(path, self.done_path(path))
+
+    def discard(self, path, error):
+        """
+            The results of the message could not be written or the message moved: moved
+            with an error report instead, or left in the spool but not submitted again.
+        """
+        try:
+            self.move(path, {'error': error})
+        except Exception as e:
+            logger.exception(e)
+            logger.info("%s left in the spool, not analysed again until restarted" % path)
+            with self.lock:
+                self.stuck.add(path)
+
+    def scan(self, settle=True):
+        """
+            If settle is True, skip the files modified recently in a plain spool: they may be partially written
+        """
+        now = time.time()
+        for fn in sorted(os.listdir(self.spool)):
+            path = os.path.join(self.spool, fn)
+            try:
+                if settle and not self.maildir and now - os.path.getmtime(path) < self.poll_interval:
+                    # Possibly still being written
+                    continue
+            except OSError:
+                continue
+            self.submit(path)
+
+    def poll(self):
+        while True:
+            self.scan()
+            time.sleep(self.poll_interval)
+
+    def inotify(self):
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+
+            def process_IN_CLOSE_WRITE(self, event):
+                watcher.submit(event.pathname)
+
+            def process_IN_MOVED_TO(self, event):
+                watcher.submit(event.pathname)
+
+            def process_IN_Q_OVERFLOW(self, event):
+                logger.info("inotify queue overflow, rescanning %s" % watcher.spool)
+                watcher.scan(settle=False)
+
+        wm = pyinotify.WatchManager()
+        wm.add_watch(self.spool, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+        notifier = pyinotify.Notifier(wm, Handler(), timeout=self.poll_interval * 1000)
+        # Files which landed before the watch was set, the others will get an event
+        self.scan(settle=False)
+        try:
+            while True:
+                notifier.process_events()
+                if notifier.check_events():
+                    notifier.read_events()
+        finally:
+            notifier.stop()
+
+    def run(self):
+        self.started = time.time()
+        stats = threading.Thread(target=self.stats_loop)
+        stats.daemon = True
+        stats.start()
+        self.pool = multiprocessing.Pool(self.workers, init_worker, maxtasksperchild=self.max_tasks)
+        # Stopped like by Ctrl-C
+        sigterm = signal.signal(signal.SIGTERM, stop)
+        try:
+            if pyinotify is not None and sys.platform.startswith('linux'):
+                logger.info("watching %s (inotify)" % self.spool)
+                self.inotify()
+            else:
+                logger.info("watching %s (polling every %is)" % (self.spool, self.poll_interval))
+                self.poll()
+        except KeyboardInterrupt:
+            logger.info("stopping, waiting for %i messages" % len(self.pending))
+        finally:
+            self.pool.close()
+            self.pool.join()
+            signal.signal(signal.SIGTERM, sigterm)
+            self.stopped.set()
+            stats.join()
+            self.report_stats()
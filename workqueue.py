@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import json
+import socket
+import hashlib
+import logging
+import sqlite3
+import threading
+
+
+# Boundary lines split the parts, parts with a file name are the attachments
+boundary_re = re.compile(br'^--[^\r\n]*\r?\n', re.M)
+headers_end_re = re.compile(br'\r?\n\r?\n')
+filename_re = re.compile(br'name\*?\s*=', re.I)
+whitespace_re = re.compile(br'\s+')
+
+
+def shard_key(raw):
+    """
+        Hash used to shard a message: the smallest hash of its attachments, so messages
+        sharing an attachment (same campaign) land on the same worker and hit its caches.
+        The raw message is only split on its boundary lines, parsing it would make the
+        coordinator the bottleneck. Attachments are hashed encoded, without the whitespaces.
+    """
+    hashes = []
+    for part in boundary_re.split(raw)[1:]:
+        split = headers_end_re.split(part, 1)
+        if len(split) == 2 and filename_re.search(split[0]):
+            hashes.append(hashlib.sha1(whitespace_re.sub(b'', split[1])).hexdigest())
+    if not hashes:
+        hashes.append(hashlib.sha1(raw).hexdigest())
+    return min(hashes)
+
+
+def get_shard(key, shards):
+    return int(key[:8], 16) % shards
+
+
+class Broker(object):
+
+    def __init__(self, lease_timeout=600, max_attempts=3, retry_delay=60):
+        """
+            A job leased and neither completed nor failed within lease_timeout seconds
+            (crashed worker) is handed to another worker, at most max_attempts times.
+            Workers extend the lease of the job they are working on.
+            A failed job is retried after retry_delay seconds, doubled at each attempt.
+        """
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.clock = time.time
+
+    def backoff(self, attempts):
+        return self.retry_delay * 2 ** (attempts - 1)
+
+    def enqueue(self, ref, shard):
+        raise NotImplementedError('You have to implement the enqueue method in the broker {}'.format(type(self).__name__))
+
+    def lease(self, worker, shards=None):
+        """
+            Returns a job dict (id, ref, shard, attempts) or None. Jobs of the given shards come
+            first, the ones of other shards are only leased when there is nothing left in them.
+        """
+        raise NotImplementedError('You have to implement the lease method in the broker {}'.format(type(self).__name__))
+
+    def extend(self, job_id, worker):
+        """
+            Returns False if the lease expired and the job went to another worker
+        """
+        raise NotImplementedError('You have to implement the extend method in the broker {}'.format(type(self).__name__))
+
+    def complete(self, job_id, worker, result):
+        raise NotImplementedError('You have to implement the complete method in the broker {}'.format(type(self).__name__))
+
+    def fail(self, job_id, worker, error):
+        raise NotImplementedError('You have to implement the fail method in the broker {}'.format(type(self).__name__))
+
+    def results(self):
+        """
+            Yields (ref, result) for the completed jobs
+        """
+        raise NotImplementedError('You have to implement the results method in the broker {}'.format(type(self).__name__))
+
+    def counts(self):
+        raise NotImplementedError('You have to implement the counts method in the broker {}'.format(type(self).__name__))
+
+
+class MemoryBroker(Broker):
+    """
+        In-process stand-in for the other brokers (tests, single node)
+    """
+
+    def __init__(self, lease_timeout=600, max_attempts=3, retry_delay=60):
+        super(MemoryBroker, self).__init__(lease_timeout, max_attempts, retry_delay)
+        self.lock = threading.Lock()
+        self.jobs = []
+
+    def enqueue(self, ref, shard):
+        with self.lock:
+            if any(job['ref'] == ref for job in self.jobs):
+                return
+            self.jobs.append({'id': len(self.jobs), 'ref': ref, 'shard': shard, 'state': 'queued',
+                              'worker': None, 'lease_until': None, 'not_before': 0, 'attempts': 0,
+                              'result': None, 'error': None})
+
+    def _available(self, job, now):
+        if job['state'] == 'leased' and job['lease_until'] < now:
+            if job['attempts'] >= self.max_attempts:
+                job['state'] = 'failed'
+                job['error'] = 'lease expired {} times'.format(job['attempts'])
+                return False
+            return True
+        return job['state'] == 'queued' and job['not_before'] <= now
+
+    def lease(self, worker, shards=None):
+        now = self.clock()
+        with self.lock:
+            available = [job for job in self.jobs if self._available(job, now)]
+            if shards is not None:
+                preferred = [job for job in available if job['shard'] in shards]
+                available = preferred or available
+            if not available:
+                return None
+            job = available[0]
+            job.update(state='leased', worker=worker, lease_until=now + self.lease_timeout,
+                       attempts=job['attempts'] + 1)
+            return dict((k, job[k]) for k in ('id', 'ref', 'shard', 'attempts'))
+
+    def extend(self, job_id, worker):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['state'] != 'leased' or job['worker'] != worker:
+                return False
+            job['lease_until'] = self.clock() + self.lease_timeout
+            return True
+
+    def complete(self, job_id, worker, result):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['state'] != 'leased' or job['worker'] != worker:
+                return False
+            job.update(state='done', result=result, lease_until=None)
+            return True
+
+    def fail(self, job_id, worker, error):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['state'] != 'leased' or job['worker'] != worker:
+                return False
+            state = 'failed' if job['attempts'] >= self.max_attempts else 'queued'
+            job.update(state=state, error=error, lease_until=None,
+                       not_before=self.clock() + self.backoff(job['attempts']))
+            return True
+
+    def results(self):
+        with self.lock:
+            done = [(job['ref'], job['result']) for job in self.jobs if job['state'] == 'done']
+        for ref, result in done:
+            yield ref, result
+
+    def counts(self):
+        counts = {}
+        with self.lock:
+            for job in self.jobs:
+                counts[job['state']] = counts.get(job['state'], 0) + 1
+        return counts
+
+
+class SQLiteBroker(Broker):
+    """
+        Queue in a SQLite database, which can be on storage shared by all the nodes
+    """
+
+    def __init__(self, path, lease_timeout=600, max_attempts=3, retry_delay=60):
+        super(SQLiteBroker, self).__init__(lease_timeout, max_attempts, retry_delay)
+        self.path = path
+        # Transactions are handled explicitly, the connection is shared with the heartbeat thread
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                               id INTEGER PRIMARY KEY, ref TEXT UNIQUE, shard INTEGER,
+                               state TEXT, worker TEXT, lease_until REAL, not_before REAL,
+                               attempts INTEGER, result TEXT, error TEXT)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, shard)')
+
+    def execute(self, query, parameters=()):
+        with self.lock:
+            return self.db.execute(query, parameters)
+
+    def enqueue(self, ref, shard):
+        self.execute("INSERT OR IGNORE INTO jobs (ref, shard, state, attempts) VALUES (?, ?, 'queued', 0)",
+                     (ref, shard))
+
+    def lease(self, worker, shards=None):
+        now = self.clock()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute("UPDATE jobs SET state = 'failed', error = 'lease expired ' || attempts || ' times' "
+                                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                                (now, self.max_attempts))
+                available = ("((state = 'queued' AND (not_before IS NULL OR not_before <= ?)) "
+                             "OR (state = 'leased' AND lease_until < ?))")
+                row = None
+                if shards is not None:
+                    row = self.db.execute('SELECT id, ref, shard, attempts FROM jobs WHERE {} AND shard IN ({}) '
+                                          'ORDER BY id LIMIT 1'.format(available, ', '.join('?' * len(shards))),
+                                          [now, now] + list(shards)).fetchone()
+                if row is None:
+                    row = self.db.execute('SELECT id, ref, shard, attempts FROM jobs WHERE {} ORDER BY id LIMIT 1'.format(available),
+                                          (now, now)).fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, "
+                                    "attempts = attempts + 1 WHERE id = ?",
+                                    (worker, now + self.lease_timeout, row[0]))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        return {'id': row[0], 'ref': row[1], 'shard': row[2], 'attempts': row[3] + 1}
+
+    def extend(self, job_id, worker):
+        cursor = self.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                              (self.clock() + self.lease_timeout, job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result):
+        cursor = self.execute("UPDATE jobs SET state = 'done', result = ?, lease_until = NULL "
+                              "WHERE id = ? AND worker = ? AND state = 'leased'",
+                              (json.dumps(result), job_id, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error):
+        # Backoff computed by backoff(), in SQL
+        cursor = self.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                              "error = ?, lease_until = NULL, not_before = ? + ? * (1 << (attempts - 1)) "
+                              "WHERE id = ? AND worker = ? AND state = 'leased'",
+                              (self.max_attempts, error, self.clock(), self.retry_delay, job_id, worker))
+        return cursor.rowcount == 1
+
+    def results(self):
+        rows = self.execute("SELECT ref, result FROM jobs WHERE state = 'done' ORDER BY id").fetchall()
+        for ref, result in rows:
+            yield ref, json.loads(result)
+
+    def counts(self):
+        return dict(self.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+
+def enqueue_messages(broker, paths, shards):
+    """
+        Coordinator: enqueue the messages found in paths, which have to be readable by all the workers
+    """
+    from emailabuse import list_messages
+    for path in list_messages(paths):
+        path = os.path.abspath(path)
+        try:
+            with open(path, 'rb') as fp:
+                shard = get_shard(shard_key(fp.read()), shards)
+            broker.enqueue(path, shard)
+        except Exception as e:
+            # Unreadable file, the others are enqueued
+            logging.exception(e)
+            logging.info("Coordinator: failed to enqueue %s: %s" % (path, e))
+            continue
+        logging.info("Coordinator: enqueued %s (shard %i)" % (path, shard))
+
+
+def heartbeat(broker, job, name, stopped):
+    """
+        Extends the lease of the job while it is being analysed
+    """
+    while not stopped.wait(broker.lease_timeout / 3.):
+        try:
+            if not broker.extend(job['id'], name):
+                logging.info("Worker %s: lease on %s lost" % (name, job['ref']))
+                return
+        except Exception as e:
+            logging.exception(e)
+
+
+def run_worker(broker, shards=None, name=None, stop_at=None, poll_interval=5, drain=False, triage=None,
+               lookup_members=False):
+    """
+        Lease jobs until interrupted, or until the queue is empty if drain is True.
+        The module caches live as long as the worker: preferring a set of shards keeps them warm.
+    """
+    from emailabuse import analyse_raw
+    if name is None:
+        name = '{}:{}'.format(socket.gethostname(), os.getpid())
+    while True:
+        job = broker.lease(name, shards)
+        if job is None:
+            if drain:
+                return
+            time.sleep(poll_interval)
+            continue
+        logging.info("Worker %s: analysing %s (shard %i, attempt %i)" % (name, job['ref'], job['shard'], job['attempts']))
+        stopped = threading.Event()
+        extender = threading.Thread(target=heartbeat, args=(broker, job, name, stopped))
+        extender.daemon = True
+        extender.start()
+        try:
+            with open(job['ref'], 'rb') as fp:
+                result = analyse_raw(fp.read(), stop_at, triage, lookup_members)
+            result.path = job['ref']
+            if not broker.complete(job['id'], name, result.to_dict()):
+                logging.info("Worker %s: lease on %s expired, result dropped" % (name, job['ref']))
+        except Exception as e:
+            # Including a result the broker cannot store: the job would crash every worker otherwise
+            logging.exception(e)
+            broker.fail(job['id'], name, str(e))
+        finally:
+            stopped.set()
+            extender.join()